@@ -1,13 +1,42 @@
 """Support for PH-803W."""
 from datetime import timedelta
+import json
 import logging
 import threading
 import time
 
 import voluptuous as vol
 
-from .lib import device
-from .const import DOMAIN
+from .lib import (
+    aggregate,
+    device,
+    exporter,
+    filters,
+    fleet,
+    flight_recorder,
+    latency,
+    proxy,
+    state,
+)
+from .lib.state import ConnectionState
+from .const import (
+    ATTR_DURATION,
+    ATTR_SAMPLE_RATE,
+    ATTR_USE_CPROFILE,
+    CONF_LONG_TERM_STATISTICS,
+    CONF_MAX_CONCURRENT_CONNECTS,
+    CONF_METRICS_PORT,
+    CONF_ORP_FILTER,
+    CONF_PH_FILTER,
+    CONF_PROXY_HOST,
+    CONF_PROXY_PORT,
+    CONF_STATE_INTERVAL,
+    DOMAIN,
+    SERVICE_DUMP_DIAGNOSTICS,
+    SERVICE_LATENCY_REPORT,
+    SERVICE_SET_LATENCY_TRACING,
+    SERVICE_START_PROFILING,
+)
 
 from homeassistant.components import persistent_notification
 from homeassistant.const import (
@@ -15,39 +44,279 @@ from homeassistant.const import (
     EVENT_HOMEASSISTANT_STOP,
     Platform,
 )
-from homeassistant.core import HomeAssistant, callback
+from homeassistant.core import HomeAssistant, ServiceCall, callback
+from homeassistant.exceptions import ServiceValidationError
 from homeassistant.helpers import config_validation as cv, discovery
-from homeassistant.helpers.dispatcher import dispatcher_send
+from homeassistant.helpers.dispatcher import (
+    async_dispatcher_connect,
+    dispatcher_send,
+)
+from homeassistant.helpers.event import async_track_time_interval
+from homeassistant.helpers.storage import Store
 from homeassistant.helpers.typing import ConfigType
+from homeassistant.util import slugify
 
 _LOGGER = logging.getLogger(__name__)
 
 UPDATE_TOPIC = f"{DOMAIN}_update"
+CONNECTED_TOPIC = f"{DOMAIN}_connected"
+STORAGE_KEY = f"{DOMAIN}.fleet"
+STORAGE_VERSION = 1
+STATISTICS_IMPORT_INTERVAL = timedelta(minutes=5)
 ERROR_ITERVAL_MAPPING = [0, 10, 60, 300, 600, 3000, 6000]
-ERROR_RECONNECT_INTERVAL = 120
+SHUTDOWN_TIMEOUT = 5
+EVENT_CONNECTION_STATE = f"{DOMAIN}_connection_state"
 NOTIFICATION_ID = "ph803w_device_notification"
 NOTIFICATION_TITLE = "PH-803W Device status"
+LATENCY_NOTIFICATION_ID = "ph803w_latency_report"
+LATENCY_NOTIFICATION_TITLE = "PH-803W Latency report"
+
 
+def valid_filter(spec):
+    """Validate the combination of filter type and parameters."""
+    try:
+        filters.create_filter(spec, 0.0)
+    except ValueError as e:
+        raise vol.Invalid(str(e)) from e
+    return spec
+
+
+POSITIVE_FLOAT = vol.All(vol.Coerce(float), vol.Range(min=0, min_included=False))
+
+# A filter name, or a mapping of the filter type and its parameters
+FILTER_SCHEMA = vol.All(
+    vol.Any(
+        vol.In(filters.FILTERS),
+        vol.Schema(
+            {
+                vol.Required("type"): vol.In(filters.FILTERS),
+                vol.Optional("history"): vol.All(vol.Coerce(int), vol.Range(min=1)),
+                vol.Optional("alpha"): vol.All(
+                    vol.Coerce(float), vol.Range(min=0, max=1, min_included=False)
+                ),
+                vol.Optional("process_noise"): POSITIVE_FLOAT,
+                vol.Optional("measurement_noise"): POSITIVE_FLOAT,
+                vol.Optional("init_error"): POSITIVE_FLOAT,
+            }
+        ),
+    ),
+    valid_filter,
+)
+
+# A host, or a host with filters overriding the ones of the integration
+HOST_SCHEMA = vol.Any(
+    vol.All(cv.string, lambda host: {CONF_HOST: host}),
+    vol.Schema(
+        {
+            vol.Required(CONF_HOST): cv.string,
+            vol.Optional(CONF_PH_FILTER): FILTER_SCHEMA,
+            vol.Optional(CONF_ORP_FILTER): FILTER_SCHEMA,
+        }
+    ),
+)
 
 CONFIG_SCHEMA = vol.Schema(
     {
         DOMAIN: vol.Schema(
             {
-                vol.Required(CONF_HOST): cv.string,
+                vol.Required(CONF_HOST): vol.All(cv.ensure_list, [HOST_SCHEMA]),
+                vol.Optional(
+                    CONF_PH_FILTER, default=filters.DEFAULT_FILTER
+                ): FILTER_SCHEMA,
+                vol.Optional(
+                    CONF_ORP_FILTER, default=filters.DEFAULT_FILTER
+                ): FILTER_SCHEMA,
+                vol.Optional(CONF_PROXY_PORT): cv.port,
+                vol.Optional(
+                    CONF_PROXY_HOST, default=proxy.DEFAULT_PROXY_HOST
+                ): cv.string,
+                vol.Optional(CONF_METRICS_PORT): cv.port,
+                vol.Optional(
+                    CONF_MAX_CONCURRENT_CONNECTS,
+                    default=fleet.MAX_CONCURRENT_CONNECTS,
+                ): vol.All(vol.Coerce(int), vol.Range(min=1)),
+                vol.Optional(CONF_LONG_TERM_STATISTICS, default=True): cv.boolean,
+                vol.Optional(CONF_STATE_INTERVAL, default=0): cv.positive_int,
             }
         )
     },
     extra=vol.ALLOW_EXTRA,
 )
 
+SET_LATENCY_TRACING_SCHEMA = vol.Schema(
+    {
+        vol.Required(ATTR_SAMPLE_RATE): vol.All(
+            vol.Coerce(float), vol.Range(min=0, max=1)
+        ),
+        vol.Optional(CONF_HOST): cv.string,
+    }
+)
+
+START_PROFILING_SCHEMA = vol.Schema(
+    {
+        vol.Optional(ATTR_DURATION, default=60): cv.positive_int,
+        vol.Optional(ATTR_USE_CPROFILE, default=False): cv.boolean,
+        vol.Optional(CONF_HOST): cv.string,
+    }
+)
+
 
 async def async_setup(hass: HomeAssistant, base_config: ConfigType) -> bool:
     """Set up waterfurnace platform."""
 
     config = base_config[DOMAIN]
 
-    hass.data[DOMAIN] = DeviceData(hass, config)
-    hass.data[DOMAIN].start()
+    metrics_exporter = None
+    if CONF_METRICS_PORT in config:
+        metrics_exporter = exporter.MetricsExporter(port=config[CONF_METRICS_PORT])
+        try:
+            await hass.async_add_executor_job(metrics_exporter.start)
+        except OSError as e:
+            _LOGGER.error(
+                f"Metrics not served on port {config[CONF_METRICS_PORT]}: {e}"
+            )
+            metrics_exporter = None
+
+    if metrics_exporter is not None:
+
+        async def stop_exporter(event):
+            await hass.async_add_executor_job(metrics_exporter.close)
+
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, stop_exporter)
+
+    # Devices healthy at the previous run connect first, fastest first
+    store = Store(hass, STORAGE_VERSION, STORAGE_KEY)
+    connect_times = (await store.async_load() or {}).get("connect_times", {})
+    connection_gate = fleet.ConnectionGate(
+        config[CONF_MAX_CONCURRENT_CONNECTS],
+        priority=sorted(connect_times, key=connect_times.get),
+    )
+
+    @callback
+    def device_connected(device_data):
+        device_client = device_data.device_client
+        if device_client is None:
+            return
+        connect_times[device_data.host] = device_client.connect_time
+        store.async_delay_save(lambda: {"connect_times": connect_times}, 10)
+
+    async_dispatcher_connect(hass, CONNECTED_TOPIC, device_connected)
+
+    statistics_importer = None
+    if config[CONF_LONG_TERM_STATISTICS] and "recorder" in hass.config.components:
+        # Imported here as the recorder is an optional dependency
+        from .long_term_statistics import StatisticsImporter
+
+        statistics_importer = StatisticsImporter(hass)
+        async_track_time_interval(
+            hass, statistics_importer.async_flush, STATISTICS_IMPORT_INTERVAL
+        )
+
+    hass.data[DOMAIN] = {}
+    for index, host_config in enumerate(config[CONF_HOST]):
+        host = host_config[CONF_HOST]
+        proxy_port = None
+        if CONF_PROXY_PORT in config:
+            proxy_port = config[CONF_PROXY_PORT] + index
+        hass.data[DOMAIN][host] = DeviceData(
+            hass,
+            host,
+            {**config, **host_config},
+            metrics_exporter,
+            connection_gate,
+            proxy_port,
+            statistics_importer,
+        )
+    for device_data in hass.data[DOMAIN].values():
+        device_data.start()
+
+    def selected_devices(call: ServiceCall):
+        if CONF_HOST not in call.data:
+            return hass.data[DOMAIN].values()
+        host = call.data[CONF_HOST]
+        if host not in hass.data[DOMAIN]:
+            raise ServiceValidationError(f"PH-803W {host} is not configured")
+        return [hass.data[DOMAIN][host]]
+
+    async def set_latency_tracing(call: ServiceCall) -> None:
+        for device_data in selected_devices(call):
+            device_data.set_latency_tracing(call.data[ATTR_SAMPLE_RATE])
+
+    async def latency_report(call: ServiceCall) -> None:
+        sections = []
+        for device_data in hass.data[DOMAIN].values():
+            tracer = device_data.tracer
+            if tracer is None:
+                sections.append(
+                    "%s: latency tracing is not enabled" % device_data.host
+                )
+                continue
+            lines = [
+                "%s latency in ms" % device_data.host,
+                "",
+                "| Stage | Count | Mean | p50 | p95 | Max |",
+                "|---|---|---|---|---|---|",
+            ]
+            for stage, values in tracer.summary().items():
+                lines.append(
+                    "| %s | %s | %s | %s | %s | %s |"
+                    % (
+                        stage,
+                        values["count"],
+                        values["mean_ms"],
+                        values["p50_ms"],
+                        values["p95_ms"],
+                        values["max_ms"],
+                    )
+                )
+            sections.append("\n".join(lines))
+        message = "\n\n".join(sections)
+        _LOGGER.info(message)
+        persistent_notification.async_create(
+            hass, message, LATENCY_NOTIFICATION_TITLE, LATENCY_NOTIFICATION_ID
+        )
+
+    hass.services.async_register(
+        DOMAIN,
+        SERVICE_SET_LATENCY_TRACING,
+        set_latency_tracing,
+        schema=SET_LATENCY_TRACING_SCHEMA,
+    )
+    hass.services.async_register(DOMAIN, SERVICE_LATENCY_REPORT, latency_report)
+
+    async def start_profiling(call: ServiceCall) -> None:
+        for device_data in selected_devices(call):
+            device_data.start_profiling(
+                call.data[ATTR_DURATION], call.data[ATTR_USE_CPROFILE]
+            )
+
+    hass.services.async_register(
+        DOMAIN,
+        SERVICE_START_PROFILING,
+        start_profiling,
+        schema=START_PROFILING_SCHEMA,
+    )
+
+    async def dump_diagnostics(call: ServiceCall) -> None:
+        # Imported here as diagnostics imports this module
+        from .diagnostics import async_get_diagnostics
+
+        data = await async_get_diagnostics(hass)
+        path = hass.config.path(f"ph803w_diagnostics_{int(time.time())}.json")
+
+        def write():
+            with open(path, "w") as file:
+                json.dump(data, file, indent=2)
+
+        await hass.async_add_executor_job(write)
+        persistent_notification.async_create(
+            hass,
+            f"Diagnostics written to {path}",
+            NOTIFICATION_TITLE,
+            NOTIFICATION_ID,
+        )
+
+    hass.services.async_register(DOMAIN, SERVICE_DUMP_DIAGNOSTICS, dump_diagnostics)
 
     discovery.load_platform(hass, Platform.SENSOR, DOMAIN, {}, config)
     discovery.load_platform(hass, Platform.BINARY_SENSOR, DOMAIN, {}, config)
@@ -62,14 +331,42 @@ class DeviceData(threading.Thread):
     for every new data, could work for the pH and ORP data but for the
     switches a more direct feedback is wanted."""
 
-    def __init__(self, hass, config) -> None:
+    def __init__(
+        self,
+        hass,
+        host,
+        config,
+        metrics_exporter=None,
+        connection_gate=None,
+        proxy_port=None,
+        statistics_importer=None,
+    ) -> None:
         super().__init__()
-        self.name = "Ph803wThread"
+        self.name = f"Ph803wThread_{host}"
         self.hass = hass
-        self.host = config[CONF_HOST]
+        self.host = host
+        self.update_topic = f"{UPDATE_TOPIC}_{host}"
+        self.ph_filter = config[CONF_PH_FILTER]
+        self.orp_filter = config[CONF_ORP_FILTER]
+        self.state_interval = config[CONF_STATE_INTERVAL]
         self.device_client = None
+        self.tracer = None
+        self.metrics_exporter = metrics_exporter
+        self.connection_gate = connection_gate
+        self.statistics_importer = statistics_importer
+        self.aggregator = aggregate.MeasurementAggregator()
+        self.proxy = None
+        if proxy_port is not None:
+            self.proxy = proxy.DeviceProxy(config[CONF_PROXY_HOST], proxy_port)
         self._shutdown = False
         self._fails = 0
+        self._wakeup = threading.Event()
+        # Client of the current connection attempt
+        self._client = None
+        self.state_machine = state.ConnectionStateMachine()
+        self.state_machine.add_listener(self._state_changed)
+        # Kept over reconnects, read by the diagnostics
+        self.flight_recorder = flight_recorder.FlightRecorder()
 
     def connected(self):
         return self.device_client is not None
@@ -89,8 +386,60 @@ class DeviceData(threading.Thread):
             return self.device_client.get_latest_measurement()
         return None
 
+    def set_latency_tracing(self, sample_rate):
+        """Trace a share of the measurements, 0 disables tracing."""
+        self.tracer = None
+        if sample_rate > 0:
+            self.tracer = latency.LatencyTracer(sample_rate)
+        if self.device_client is not None:
+            self.device_client.tracer = self.tracer
+
+    def start_profiling(self, duration, use_cprofile):
+        """Profile the device frame handling, results written to the config dir."""
+        if self.device_client is None:
+            _LOGGER.warning(f"Not profiling {self.host}, device not connected")
+            return
+        extension = "prof" if use_cprofile else "txt"
+        path = self.hass.config.path(
+            f"ph803w_profile_{slugify(self.host)}_{int(time.time())}.{extension}"
+        )
+        if not self.device_client.start_profiling(duration, path, use_cprofile):
+            _LOGGER.warning(f"Not profiling {self.host}, profiling already running")
+            return
+        _LOGGER.info(f"Profiling {self.host} for {duration}s into {path}")
+
+    @callback
+    def write_state(self, measurement, write_ha_state):
+        """Write entity state, recording the latency of traced measurements.
+
+        Only the first entity writing a measurement records it, so there is
+        one sample per stage and measurement."""
+        tracer = self.tracer
+        if (
+            measurement is None
+            or not measurement.traced
+            or measurement.written
+            or tracer is None
+        ):
+            write_ha_state()
+            return
+        measurement.written = True
+        start = time.monotonic()
+        dispatched = measurement.dispatched
+        # The event loop may pick it up before the device callbacks returned
+        tracer.observe(
+            "handoff", 0.0 if dispatched is None else max(0.0, start - dispatched)
+        )
+        write_ha_state()
+        end = time.monotonic()
+        tracer.observe("write_state", end - start)
+        tracer.observe("total", end - measurement.received)
+
     def run(self):
-        """Thread run loop."""
+        """Thread run loop.
+
+        Every connection attempt passes the states of the state machine,
+        each bounded by a deadline, and ends in a backoff until shutdown."""
 
         @callback
         def register():
@@ -100,74 +449,104 @@ class DeviceData(threading.Thread):
                 """Shutdown the thread."""
                 _LOGGER.info("Signaled to shutdown")
                 self._shutdown = True
-                if self.device_client is not None:
-                    self.device_client.abort()
-                self.join()
+                self._wakeup.set()
+                client = self._client
+                if client is not None:
+                    client.abort()
+                if self.proxy is not None:
+                    self.proxy.close()
+                self.join(SHUTDOWN_TIMEOUT)
 
             self.hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, shutdown)
 
         self.hass.add_job(register)
 
-        # This does a tight loop in sending ping/pong to the
-        # device. That's a blocking call, which returns pretty
-        # quickly (0.5 second). It's important that we do this
-        # frequently though, because if we don't call the websocket at
-        # least every 4 seconds the device side closes the
-        # connection.
-        while True:
+        if self.proxy is not None:
+            try:
+                self.proxy.start()
+            except OSError as e:
+                _LOGGER.error(
+                    f"Proxy for {self.host} not started on port {self.proxy.port}: {e}"
+                )
+                self.proxy = None
+
+        while not self._shutdown:
             self.device_client = None
 
             _LOGGER.info(f"Attempting to connect to device at {self.host}")
-            device_client = device.Device(self.host)
+            client = device.Device(
+                self.host,
+                ph_filter=self.ph_filter,
+                orp_filter=self.orp_filter,
+                connection_gate=self.connection_gate,
+                flight_recorder=self.flight_recorder,
+                state_machine=self.state_machine,
+            )
+            client.tracer = self.tracer
+            client.register_callback(lambda client=client: self._new_data(client))
+            if self.proxy is not None:
+                self.proxy.attach(client)
+            if self.metrics_exporter is not None:
+                self.metrics_exporter.set_device(client)
+            self._client = client
+            if self._shutdown:
+                # Signaled before the client was visible to abort
+                client.close()
+                break
 
             try:
-                if not device_client.run(once=True):
-                    _LOGGER.info(
-                        f"Device found but no measurement was received, reconnecting in {ERROR_RECONNECT_INTERVAL} seconds")
-                    time.sleep(ERROR_RECONNECT_INTERVAL)
-                    continue
-
+                client.run(once=False)
             except Exception as e:
-                _LOGGER.info(
-                    f"Error connecting to device at {self.host}: {str(e)}")
-                _LOGGER.info(
-                    f"Retrying connection in {ERROR_RECONNECT_INTERVAL} seconds")
-                time.sleep(ERROR_RECONNECT_INTERVAL)
-                continue
-
-            self.device_client = device_client
-            _LOGGER.debug("Registering callbacks")
-            self.device_client.register_callback(self.dispatcher_new_data)
-            self.device_client.register_callback(self.reset_fail_counter)
-
-            _LOGGER.info(f"Connected to {self.host}")
-
-            while True:
-                if self._shutdown:
-                    _LOGGER.debug("Graceful shutdown")
-                    return
-
-                try:
-                    _LOGGER.info("Starting device client loop")
-                    self.device_client.run(once=False)
-                except Exception as e:
-                    _LOGGER.exception(f"Failed to read data: {str(e)}")
-                    self.device_client.close()
-                    self._fails += 1
-                    error_mapping = self._fails
-                    if error_mapping >= len(ERROR_ITERVAL_MAPPING):
-                        error_mapping = len(ERROR_ITERVAL_MAPPING) - 1
-                    sleep_time = ERROR_ITERVAL_MAPPING[error_mapping]
-                    _LOGGER.info(
-                        f"Sleeping {str(sleep_time)}s for failure #{str(self._fails)}")
-                    self.device_client.reset_socket()
-                    time.sleep(sleep_time)
-
-    @callback
-    def reset_fail_counter(self):
-        self._fails = 0
-
-    @callback
-    def dispatcher_new_data(self):
-        """Noyifying HASS that new data is ready to read."""
-        dispatcher_send(self.hass, UPDATE_TOPIC)
+                _LOGGER.info(f"Connection to device at {self.host} failed: {str(e)}")
+                client.close()
+            if self._shutdown:
+                break
+
+            self._fails += 1
+            sleep_time = ERROR_ITERVAL_MAPPING[
+                min(self._fails, len(ERROR_ITERVAL_MAPPING) - 1)
+            ]
+            _LOGGER.info(
+                f"Reconnecting in {str(sleep_time)}s after failure #{str(self._fails)}"
+            )
+            self._backoff(sleep_time)
+
+        self._client = None
+        self.state_machine.transition(ConnectionState.STOPPED)
+        _LOGGER.debug("Graceful shutdown")
+
+    def _backoff(self, seconds):
+        """Wait in the backoff state until its deadline or a shutdown."""
+        self._wakeup.clear()
+        if self._shutdown:
+            return
+        self.state_machine.transition(
+            ConnectionState.BACKOFF, self._wakeup.set, deadline=seconds
+        )
+        self._wakeup.wait()
+
+    def _new_data(self, client):
+        """Called from the device client for new data or a closed connection."""
+        latest = client.get_latest_measurement()
+        if self.device_client is not client and latest is not None:
+            # First measurement of this connection
+            self.device_client = client
+            self._fails = 0
+            _LOGGER.info(f"Connected to {self.host} in {client.connect_time:.3f}s")
+            dispatcher_send(self.hass, CONNECTED_TOPIC, self)
+        if latest is not None:
+            for channel, ended in self.aggregator.add(latest):
+                if self.statistics_importer is not None:
+                    self.statistics_importer.add(self.host, channel, ended)
+        dispatcher_send(self.hass, self.update_topic)
+
+    def _state_changed(self, old_state, new_state):
+        self.hass.bus.fire(
+            EVENT_CONNECTION_STATE,
+            {
+                CONF_HOST: self.host,
+                "old_state": old_state.value,
+                "new_state": new_state.value,
+            },
+        )
+        dispatcher_send(self.hass, self.update_topic)
@@ -1 +1,19 @@
 DOMAIN = "ph803w"
+
+CONF_PH_FILTER = "ph_filter"
+CONF_ORP_FILTER = "orp_filter"
+CONF_PROXY_HOST = "proxy_host"
+CONF_PROXY_PORT = "proxy_port"
+CONF_METRICS_PORT = "metrics_port"
+CONF_MAX_CONCURRENT_CONNECTS = "max_concurrent_connects"
+CONF_LONG_TERM_STATISTICS = "long_term_statistics"
+CONF_STATE_INTERVAL = "state_interval"
+
+ATTR_SAMPLE_RATE = "sample_rate"
+ATTR_DURATION = "duration"
+ATTR_USE_CPROFILE = "use_cprofile"
+
+SERVICE_SET_LATENCY_TRACING = "set_latency_tracing"
+SERVICE_LATENCY_REPORT = "latency_report"
+SERVICE_START_PROFILING = "start_profiling"
+SERVICE_DUMP_DIAGNOSTICS = "dump_diagnostics"
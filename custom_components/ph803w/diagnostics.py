@@ -0,0 +1,57 @@
+"""Diagnostics support for PH-803W."""
+from __future__ import annotations
+
+from typing import Any
+
+from homeassistant.components.diagnostics import async_redact_data
+from homeassistant.core import HomeAssistant
+
+from .const import DOMAIN
+
+TO_REDACT = {"passcode"}
+
+
+async def async_get_diagnostics(hass: HomeAssistant) -> dict[str, Any]:
+    """Return diagnostics of all devices.
+
+    The integration is set up from YAML without config entries, so this is
+    provided through the dump_diagnostics service."""
+    devices = {}
+    for host, device_data in hass.data[DOMAIN].items():
+        device_client = device_data.device_client
+        data = {
+            "connected": device_data.connected(),
+            "passcode": device_data.passcode(),
+            "fails": device_data._fails,
+            "flight_recorder": device_data.flight_recorder.dump(),
+        }
+        if device_client is not None:
+            data["connect_time"] = device_client.connect_time
+            data["counters"] = dict(device_client.counters)
+            measurement = device_client.get_latest_measurement()
+            if measurement is not None:
+                data["measurement"] = {
+                    "ph": measurement.ph,
+                    "raw_ph": measurement.raw_ph,
+                    "orp": measurement.orp,
+                    "raw_orp": measurement.raw_orp,
+                    "in_water": measurement.in_water,
+                    "ph_on": measurement.ph_on,
+                    "orp_on": measurement.orp_on,
+                }
+        aggregates = {}
+        for (channel, period), completed in device_data.aggregator.completed.items():
+            aggregates[f"{channel}_{period}s"] = [
+                {
+                    "start": ended.start,
+                    "mean": ended.mean,
+                    "min": ended.min,
+                    "max": ended.max,
+                }
+                for ended in list(completed)[-12:]
+            ]
+        data["aggregates"] = aggregates
+        if device_data.tracer is not None:
+            data["latency"] = device_data.tracer.summary()
+        devices[host] = data
+    return async_redact_data({"devices": devices}, TO_REDACT)
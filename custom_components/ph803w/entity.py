@@ -0,0 +1,112 @@
+"""Base entity for PH-803W."""
+from __future__ import annotations
+
+from collections.abc import Callable
+from dataclasses import dataclass
+import logging
+from operator import attrgetter
+from typing import Any
+
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers.device_registry import DeviceInfo
+from homeassistant.helpers.dispatcher import async_dispatcher_connect
+from homeassistant.helpers.entity import Entity, EntityDescription
+from homeassistant.helpers.entity_platform import AddEntitiesCallback
+from homeassistant.util import slugify
+
+from . import CONNECTED_TOPIC
+from .const import DOMAIN
+from .lib.device import Measurement
+
+_LOGGER = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True, kw_only=True)
+class DeviceEntityDescription(EntityDescription):
+    """Describes a PH-803W entity, value_fn reads its value from a measurement.
+
+    The key is used as measurement attribute when no value_fn is given."""
+
+    value_fn: Callable[[Measurement], Any] | None = None
+
+
+def async_setup_device_entities(
+    hass: HomeAssistant,
+    async_add_entities: AddEntitiesCallback,
+    create_entities: Callable[[Any], list[Entity]],
+) -> None:
+    """Add the entities of every device once it has connected (and has a passcode)."""
+    added = set()
+
+    @callback
+    def add_device_entities(device_data):
+        if device_data.host in added:
+            return
+        added.add(device_data.host)
+        _LOGGER.info(f"PH-803W {device_data.host} connected, creating entities")
+        async_add_entities(create_entities(device_data))
+
+    for device_data in hass.data[DOMAIN].values():
+        if device_data.connected():
+            add_device_entities(device_data)
+    async_dispatcher_connect(hass, CONNECTED_TOPIC, add_device_entities)
+
+
+class DeviceEntity(Entity):
+    """Base of the PH-803W entities.
+
+    Identity, device info and the value accessor are resolved once, an
+    update only reads the value and writes the state."""
+
+    entity_description: DeviceEntityDescription
+    entity_id_format: str
+    # Entity attribute holding the value, e.g. _attr_native_value
+    _value_attr: str
+    _attr_should_poll = False
+
+    def __init__(self, device_data, description: DeviceEntityDescription) -> None:
+        """Initialize the entity."""
+        self.device_data = device_data
+        self.entity_description = description
+        self._value_fn = description.value_fn or attrgetter(description.key)
+        passcode = device_data.passcode()
+        if passcode is not None:
+            self._attr_unique_id = passcode + description.key
+            self._attr_device_info = DeviceInfo(
+                identifiers={(DOMAIN, passcode)},
+                name=device_data.unique_name(),
+            )
+        # This ensures that the entities are isolated per device
+        self.entity_id = self.entity_id_format.format(
+            f"wf_{slugify(device_data.host)}_{slugify(description.key)}"
+        )
+        self._update_value(device_data.measurement())
+
+    def _update_value(self, measurement: Measurement | None) -> None:
+        """Read the value of the measurement into the entity state."""
+        setattr(
+            self,
+            self._value_attr,
+            None if measurement is None else self._value_fn(measurement),
+        )
+
+    def _skip_update(self, measurement: Measurement | None) -> bool:
+        """Return True to leave this update out."""
+        return False
+
+    async def async_added_to_hass(self) -> None:
+        """Register callbacks."""
+        self.async_on_remove(
+            async_dispatcher_connect(
+                self.hass, self.device_data.update_topic, self.async_update_callback
+            )
+        )
+
+    @callback
+    def async_update_callback(self) -> None:
+        """Update state."""
+        measurement = self.device_data.measurement()
+        if self._skip_update(measurement):
+            return
+        self._update_value(measurement)
+        self.device_data.write_state(measurement, self.async_write_ha_state)
@@ -0,0 +1,91 @@
+"""Downsampling of PH-803W measurements into periodic aggregates."""
+from collections import deque
+
+# Measurement attributes aggregated and the periods in seconds
+AGGREGATE_CHANNELS = ("ph", "orp")
+AGGREGATE_PERIODS = (300, 3600)
+AGGREGATE_HISTORY = 288
+
+
+class Aggregate:
+    """Count, sum, min and max of the values in one period."""
+
+    __slots__ = ("start", "period", "count", "total", "min", "max")
+
+    def __init__(self, start: float, period: float, value: float) -> None:
+        self.start = start
+        self.period = period
+        self.count = 1
+        self.total = value
+        self.min = value
+        self.max = value
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count
+
+    def __str__(self) -> str:
+        return "Start: %s, Period: %s, Mean: %s, Min: %s, Max: %s" % (
+            self.start,
+            self.period,
+            self.mean,
+            self.min,
+            self.max,
+        )
+
+
+class Aggregator:
+    """Aggregates of one value over periods aligned to the epoch."""
+
+    def __init__(self, period: float) -> None:
+        self.period = period
+        self.current = None
+
+    def add(self, timestamp: float, value: float):
+        """Add a value, returns the previous aggregate when its period ended."""
+        current = self.current
+        if current is not None and timestamp < current.start + self.period:
+            current.add(value)
+            return None
+        start = timestamp - timestamp % self.period
+        self.current = Aggregate(start, self.period, value)
+        return current
+
+
+class MeasurementAggregator:
+    """Aggregates per channel and period, keeping the latest completed ones."""
+
+    def __init__(
+        self,
+        channels=AGGREGATE_CHANNELS,
+        periods=AGGREGATE_PERIODS,
+        history: int = AGGREGATE_HISTORY,
+    ) -> None:
+        self._aggregators = [
+            (channel, Aggregator(period)) for channel in channels for period in periods
+        ]
+        self.completed = {
+            (channel, period): deque(maxlen=history)
+            for channel in channels
+            for period in periods
+        }
+
+    def add(self, measurement) -> list:
+        """Add a measurement, returns (channel, aggregate) of the ended periods."""
+        completed = []
+        for channel, aggregator in self._aggregators:
+            aggregate = aggregator.add(
+                measurement.timestamp, getattr(measurement, channel)
+            )
+            if aggregate is not None:
+                self.completed[(channel, aggregator.period)].append(aggregate)
+                completed.append((channel, aggregate))
+        return completed
@@ -0,0 +1,133 @@
+"""Columnar analysis of PH-803W measurement history with NumPy.
+
+NumPy is an optional dependency, only needed when using this module."""
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+# Columns returned, float64 values except for the boolean flags
+VALUE_COLUMNS = ("timestamp", "ph", "orp", "raw_ph", "raw_orp")
+FLAG_COLUMNS = ("in_water", "ph_on", "orp_on")
+FRAME_LENGTH = 18
+# Windows handled at once by the outlier filter, bounds its temporary arrays
+OUTLIER_CHUNK = 65536
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("numpy is required for the PH-803W analytics")
+
+
+def history_arrays(source) -> dict:
+    """Columns of a device history (Device) or any iterable of Measurement."""
+    _require_numpy()
+    if hasattr(source, "get_measurements"):
+        source = source.get_measurements()
+    measurements = list(source)
+    count = len(measurements)
+    columns = {}
+    for column in VALUE_COLUMNS:
+        columns[column] = np.fromiter(
+            (getattr(m, column) for m in measurements), dtype=np.float64, count=count
+        )
+    for column in FLAG_COLUMNS:
+        columns[column] = np.fromiter(
+            (getattr(m, column) for m in measurements), dtype=bool, count=count
+        )
+    return columns
+
+
+def frame_arrays(frames, timestamps) -> dict:
+    """Columns decoded in bulk from raw 0x91 data frames (e.g. a persisted log).
+
+    The values are unfiltered, ph and orp equal raw_ph and raw_orp."""
+    _require_numpy()
+    raw = np.frombuffer(b"".join(bytes(f[:FRAME_LENGTH]) for f in frames), np.uint8)
+    raw = raw.reshape(-1, FRAME_LENGTH)
+    ph = ((raw[:, 10].astype(np.int32) << 8) | raw[:, 11]) * 0.01
+    orp = (((raw[:, 12].astype(np.int32) << 8) | raw[:, 13]) - 2000).astype(np.float64)
+    return {
+        "timestamp": np.asarray(timestamps, dtype=np.float64),
+        "ph": ph,
+        "orp": orp,
+        "raw_ph": ph,
+        "raw_orp": orp,
+        "in_water": raw[:, 8] & 0b0000_0100 != 0,
+        "ph_on": raw[:, 9] & 0b0000_0001 != 0,
+        "orp_on": raw[:, 9] & 0b0000_0010 != 0,
+    }
+
+
+def resample(timestamps, values, period: float) -> dict:
+    """Mean, min and max of values per period (aligned to the epoch).
+
+    Only periods containing values are returned, timestamps must be sorted."""
+    _require_numpy()
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    buckets = np.floor(timestamps / period).astype(np.int64)
+    starts, first, counts = np.unique(buckets, return_index=True, return_counts=True)
+    return {
+        "start": starts * period,
+        "count": counts,
+        "mean": np.add.reduceat(values, first) / counts,
+        "min": np.minimum.reduceat(values, first),
+        "max": np.maximum.reduceat(values, first),
+    }
+
+
+def drift(timestamps, values, window: float = None) -> float:
+    """Linear trend of values in units per hour, over the last window seconds."""
+    _require_numpy()
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) < 2:
+        return 0.0
+    if window is not None:
+        recent = timestamps >= timestamps[-1] - window
+        timestamps = timestamps[recent]
+        values = values[recent]
+    if len(values) < 2:
+        return 0.0
+    hours = (timestamps - timestamps[0]) / 3600
+    return float(np.polyfit(hours, values, 1)[0])
+
+
+def outlier_filter(values, history: int = 10, chunk: int = OUTLIER_CHUNK):
+    """The outlier filter of the device run over a whole array.
+
+    Each value is replaced by the latest value of its trailing window that
+    is within one (sample) standard deviation of the window mean. The
+    windows are handled chunk at a time, so the temporary arrays stay at
+    chunk x history values also for long histories."""
+    _require_numpy()
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return values.copy()
+    # Pad the start with NaN so every position has a full window, the
+    # windows are a view on it
+    padded = np.concatenate((np.full(history - 1, np.nan), values))
+    windows = np.lib.stride_tricks.sliding_window_view(padded, history)
+    filtered = np.empty_like(values)
+    for start in range(0, len(values), chunk):
+        end = start + chunk
+        filtered[start:end] = _outlier_windows(windows[start:end], values[start:end])
+    return filtered
+
+
+def _outlier_windows(windows, values):
+    history = windows.shape[1]
+    counts = np.sum(~np.isnan(windows), axis=1)
+    mean = np.nanmean(windows, axis=1)
+    deviation = np.abs(windows - mean[:, None])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        stddev = np.sqrt(np.nansum(deviation**2, axis=1) / (counts - 1))
+    stddev = stddev + 1e-9 * np.maximum(1.0, np.abs(mean))
+    inlier = deviation <= stddev[:, None]
+    # Index of the last inlier in each window, the latest value if none
+    last = history - 1 - np.argmax(inlier[:, ::-1], axis=1)
+    last[~inlier.any(axis=1)] = history - 1
+    filtered = windows[np.arange(len(windows)), last]
+    # A single value has no deviation, it is used as is
+    return np.where(counts < 2, values, filtered)
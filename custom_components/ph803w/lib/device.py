@@ -1,15 +1,34 @@
 """A PH-803W device value collector."""
-from statistics import stdev, mean, StatisticsError
-import threading
+from collections import Counter, deque
 import socket
 import logging
-from time import sleep
+from time import monotonic, perf_counter, time
+
+from .filters import (  # noqa: F401, outlier filters kept importable from here
+    DEFAULT_FILTER,
+    MeasFilter,
+    MeasOutlierFilter,
+    OutlierFilter,
+)
+from . import flight_recorder as fr
+from .profiling import Profiler
+from .scheduler import get_scheduler
+from .state import ConnectionState, ConnectionStateMachine
 
 PH803W_DEFAULT_TCP_PORT = 12416
 PH803W_PING_INTERVAL = 4
+MEASUREMENT_HISTORY = 100
 RECONNECT_DELAY = 10
-# RESPONSE_TIMEOUT = 5000
-ABORT_AFTER_CONSECUTIVE_EMPTY = 30
+# Without any data (the device answers every ping) the peer is considered
+# dead, also applied to connect and handshake
+SOCKET_TIMEOUT = 15
+# TCP keepalive: idle seconds before probing, probe interval and count
+KEEPALIVE_IDLE = 10
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_COUNT = 3
+# Without any frame (the device answers every ping) the connection is closed
+PONG_TIMEOUT = 3 * PH803W_PING_INTERVAL
+FIRST_FRAME_TIMEOUT = 30
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -18,49 +37,149 @@ class DeviceError(ConnectionError):
     pass
 
 
+def create_socket() -> socket.socket:
+    """Create a device socket with timeout, keepalive and no Nagle delay."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(SOCKET_TIMEOUT)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # Keepalive tuning is platform specific
+    for option, value in (
+        ("TCP_KEEPIDLE", KEEPALIVE_IDLE),
+        ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+        ("TCP_KEEPCNT", KEEPALIVE_COUNT),
+    ):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+    return sock
+
+
 class Device(object):
-    def __init__(self, host):
+    def __init__(
+        self,
+        host,
+        ph_filter=DEFAULT_FILTER,
+        orp_filter=DEFAULT_FILTER,
+        port=PH803W_DEFAULT_TCP_PORT,
+        scheduler=None,
+        connection_gate=None,
+        flight_recorder=None,
+        state_machine=None,
+    ):
         self.host = host
+        self.port = port
         self.passcode = ""
-        self._measurements = []
+        self._measurements = deque(maxlen=MEASUREMENT_HISTORY)
         self._latest_measurement = None
         self._measurements_filter = None
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._ph_filter = ph_filter
+        self._orp_filter = orp_filter
+        self._socket = create_socket()
         self._loop = True
-        self._empty_counter = 0
-        self._pong_thread = None
+        # Set by abort, unlike _loop not reset by a (later) run
+        self._aborted = False
+        self._scheduler = scheduler or get_scheduler()
+        self.state_machine = state_machine or ConnectionStateMachine(self._scheduler)
+        # Optional fleet.ConnectionGate limiting concurrent handshakes
+        self._connection_gate = connection_gate
+        # Optional flight_recorder.FlightRecorder of frames and events
+        self.flight_recorder = flight_recorder
+        # Duration of the latest successful handshake
+        self.connect_time = None
+        self._ping_timer = None
+        self._first_frame_timer = None
+        self._last_received = 0
+        self._interrupt_reason = None
+        # A shutdown of a socket not connected yet breaks its later connect
+        self._connected = False
         self._callbacks = []
+        self._frame_callbacks = []
+        self._close_callbacks = []
+        # Connection counters: connects, frames, measurements, closes
+        self.counters = Counter()
+        # Optional latency.LatencyTracer
+        self.tracer = None
+        self._profiler = None
 
     def reset_socket(self):
         try:
             self._socket.close()
         except:
             pass
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket = create_socket()
+        self._connected = False
 
     async def run_async(self, once: bool = True) -> bool:
         return self.run(once)
 
     def run(self, once: bool = True) -> bool:
         self._loop = True
+        if self._aborted:
+            raise DeviceError("Aborted")
+        self._interrupt_reason = None
         if self._socket.fileno() == -1:
             self.reset_socket()
-        self._connect()
+        # Discovering covers resolving the address and waiting for a
+        # connection slot, bounded by the resolver and the gate
+        self.state_machine.transition(ConnectionState.DISCOVERING)
+        address = socket.getaddrinfo(
+            self.host, self.port, socket.AF_INET, socket.SOCK_STREAM
+        )[0][4]
+        if self._connection_gate is None:
+            self._connect(address)
+        else:
+            with self._connection_gate.slot(self.host):
+                self._connect(address)
         if once:
             return self._run(once)
         else:
             self._run(once)
             return not self._loop
 
+    def start_profiling(
+        self, duration: float, path: str, use_cprofile: bool = False
+    ) -> bool:
+        """Profile the frame handling for duration seconds, results written to path.
+
+        Profiling starts and stops with the next frame received, a cProfile
+        can only be stopped from the device thread. Returns False, without
+        starting, while a profiling is still running."""
+        if self._profiler is not None:
+            return False
+        self._profiler = Profiler(duration, path, use_cprofile)
+        return True
+
+    def stop_profiling(self):
+        profiler = self._profiler
+        self._profiler = None
+        if profiler is not None:
+            profiler.finish()
+
     def register_callback(self, callback_function):
         self._callbacks.append(callback_function)
 
+    def register_frame_callback(self, callback_function):
+        """Register a function called with every valid raw frame received."""
+        self._frame_callbacks.append(callback_function)
+
+    def register_close_callback(self, callback_function):
+        """Register a function called when the connection is closed."""
+        self._close_callbacks.append(callback_function)
+
     def get_unique_name(self) -> str:
         return "PH-803W_%s" % self.passcode
 
-    def _connect(self) -> bool:
-        self._loop = True
-        self._socket.connect((self.host, PH803W_DEFAULT_TCP_PORT))
+    def _connect(self, address=None) -> bool:
+        if not self._loop:
+            raise DeviceError(self._interrupt_reason or "Aborted")
+        self._interrupt_reason = None
+        self._record_event(fr.EVENT_CONNECTING)
+        # The connect is bounded by the socket timeout
+        self.state_machine.transition(ConnectionState.CONNECTING)
+        start = monotonic()
+        self._socket.connect(address or (self.host, self.port))
+        self._connected = True
+        self.state_machine.transition(ConnectionState.HANDSHAKE, self._state_deadline)
 
         # Send request for connection
         data = bytes.fromhex("0000000303000006")
@@ -68,6 +187,10 @@ class Device(object):
 
         # Receive response and passcode
         response = self._socket.recv(1024)
+        if len(response) < 10:
+            raise DeviceError(
+                self._interrupt_reason or "Connection closed during handshake"
+            )
         passcode_lenth = response[9]
         passcode_raw = response[10 : 10 + passcode_lenth]
         self.passcode = passcode_raw.decode("utf-8")
@@ -83,73 +206,104 @@ class Device(object):
 
         # Receive confirmation
         response = self._socket.recv(1024)
-        if response[8] != 0:
-            raise DeviceError("Error connecting")
+        if len(response) < 9 or response[8] != 0:
+            raise DeviceError(self._interrupt_reason or "Error connecting")
+        self.counters["connects"] += 1
+        self.connect_time = monotonic() - start
+        _LOGGER.debug("Connected in %.3f seconds", self.connect_time)
+        self._record_event(fr.EVENT_CONNECTED)
 
     def _run(self, once: bool = True) -> bool:
         # Connection established, start requesting data,
         # from now on some cyclig bahavior
         data = bytes.fromhex("000000030400009002")
         self._socket.sendall(data)
-        self._empty_counter = 0
 
+        self.state_machine.transition(ConnectionState.STREAMING)
+        self._last_received = monotonic()
+        self._first_frame_timer = self._scheduler.call_later(
+            FIRST_FRAME_TIMEOUT, self._first_frame_timeout
+        )
         # If continous reading ping/pong needs to be run cyclic
         if not once:
-            self._pong_thread = threading.Thread(target=self._ping_loop)
-            self._pong_thread.daemon = True
-            self._pong_thread.start()
+            self._ping_timer = self._scheduler.call_every(
+                PH803W_PING_INTERVAL, self._ping
+            )
         else:
             self._send_ping()
 
-        while self._loop:
-            response = self._socket.recv(1024)
-            if self._empty_counter > ABORT_AFTER_CONSECUTIVE_EMPTY:
-                _LOGGER.warning("Too many empty consecutive packages")
-                raise DeviceError("Too many empty consecutive packages")
-            if len(response) == 0:
-                self._empty_counter += 1
-                if self._empty_counter % 10 == 0:
-                    _LOGGER.warning(
-                        "%s %s empty messages received"
-                        % (self._empty_bar(), self._empty_counter)
+        try:
+            while self._loop:
+                try:
+                    response = self._socket.recv(1024)
+                    received = monotonic()
+                except socket.timeout:
+                    if not self._loop:
+                        break
+                    self._record_event(fr.EVENT_TIMEOUT)
+                    raise DeviceError(
+                        "No data received in %s seconds" % SOCKET_TIMEOUT
+                    ) from None
+                except OSError:
+                    self._record_event(fr.EVENT_ERROR)
+                    raise
+                if len(response) == 0:
+                    if not self._loop:
+                        break
+                    self._record_event(fr.EVENT_CLOSED_BY_DEVICE)
+                    raise DeviceError(
+                        self._interrupt_reason or "Connection closed by device"
                     )
-                continue
-            self._empty_counter = 0
-
-            self._handle_response(response)
-
-            if once and len(self._measurements) > 0:
-                self._loop = False
+                self._last_received = received
+
+                profiler = self._profiler
+                if profiler is None:
+                    self._handle_response(response, received)
+                else:
+                    profiler.enable()
+                    start = perf_counter()
+                    self._handle_response(response, received)
+                    profiler.lap("_handle_response", start)
+                    if profiler.expired():
+                        self.stop_profiling()
+
+                if once and len(self._measurements) > 0:
+                    self._loop = False
+        finally:
+            # Profiling results are written also when the connection fails
+            self.stop_profiling()
         self.close()
         return (once and len(self._measurements) > 0) or not once
 
-    def _empty_bar(self) -> str:
-        empty_filled = int(self._empty_counter * 10 / ABORT_AFTER_CONSECUTIVE_EMPTY)
-        empty_clear = 10 - empty_filled
-        return "[" + ("#" * empty_filled) + (" " * empty_clear) + "]"
-
-    def _handle_response(self, data):
+    def _handle_response(self, data, received=None):
         if data[0] != 0 and data[1] != 0 and data[2] != 0 and data[2] != 3:
-            _LOGGER.warning(
-                "Ignore data package because invalid prefix: %s" % data[0:3]
-            )
+            _LOGGER.warning("Ignore data package because invalid prefix: %s", data[0:3])
             return
         data_length = data[4]
+        additional_data = None
         if len(data) != data_length + 5:
-            if len(data) > data_length:
-                additional_data = data[data_length : len(data)]
-                data = data[0:data_length]
+            if len(data) > data_length + 5:
+                additional_data = data[data_length + 5 : len(data)]
+                data = data[0 : data_length + 5]
                 _LOGGER.debug(
                     "Split into two data packages because additional data detected."
                 )
-                self._handle_response(additional_data)
             else:
                 _LOGGER.warning(
-                    "Ignore data package because invalid length(%s): %s"
-                    % (data_length, data)
+                    "Ignore data package because invalid length(%s): %s",
+                    data_length,
+                    data,
                 )
                 return
 
+        self.counters["frames"] += 1
+        if self.flight_recorder is not None:
+            self.flight_recorder.frame(
+                data, monotonic() if received is None else received
+            )
+        for callback in self._frame_callbacks:
+            callback(data)
+
         message_type = data[7]
         if message_type == 0x07:
             self._handle_passcode_response(data)
@@ -158,38 +312,61 @@ class Device(object):
         elif message_type == 0x16:
             self._handle_ping_pong_response()
         elif message_type == 0x91:
-            self._handle_data_response(data)
+            self._handle_data_response(data, received)
         elif message_type == 0x94:
             self._handle_data_extended_response(data)
         else:
             _LOGGER.warning(
-                "Ignore data package because invalid message type %s" % message_type
+                "Ignore data package because invalid message type %s", message_type
             )
 
+        if additional_data:
+            self._handle_response(additional_data, received)
+
     def _handle_passcode_response(self, data):
         _LOGGER.warning("Passcode resonse ignored")
 
     def _handle_login_response(self, data):
         _LOGGER.warning("Login resonse ignored")
 
-    def _handle_data_response(self, data):
+    def _handle_data_response(self, data, received=None):
         if len(data) == 18:
-            meas = Measurement(data)
+            profiler = self._profiler
+            if profiler is not None:
+                start = perf_counter()
+            meas = Measurement(data, received)
+            if profiler is not None:
+                start = profiler.lap("Measurement", start)
+            tracer = self.tracer
+            if tracer is not None and tracer.sample():
+                meas.traced = True
+                decoded = monotonic()
+                tracer.observe("decode", decoded - meas.received)
             if self._measurements_filter is None:
-                self._measurements_filter = MeasOutlierFilter(meas.ph, meas.orp)
+                self._measurements_filter = MeasFilter(
+                    meas.ph, meas.orp, self._ph_filter, self._orp_filter
+                )
             else:
                 self._measurements_filter.add(meas.ph, meas.orp)
             meas.add_filtered(
                 self._measurements_filter.get_ph(), self._measurements_filter.get_orp()
             )
-            _LOGGER.debug("Adding result: %s" % meas)
+            if profiler is not None:
+                start = profiler.lap("filter", start)
+            if meas.traced:
+                filtered = monotonic()
+                tracer.observe("filter", filtered - decoded)
+            _LOGGER.debug("Adding result: %s", meas)
+            self.counters["measurements"] += 1
             self._measurements.append(meas)
             self._latest_measurement = meas
-            if len(self._measurements) > 100:
-                self._measurements.pop(0)
             for callback in self._callbacks:
                 callback()
-            _LOGGER.debug(meas)
+            if profiler is not None:
+                profiler.lap("callbacks", start)
+            if meas.traced:
+                meas.dispatched = monotonic()
+                tracer.observe("callbacks", meas.dispatched - filtered)
 
     def _handle_data_extended_response(self, data):
         _LOGGER.warning("Extended data ignored")
@@ -202,27 +379,84 @@ class Device(object):
         self._socket.sendall(pong_data)
         _LOGGER.debug("Ping sent")
 
-    def _ping_loop(self):
-        while self._loop:
+    def _ping(self):
+        """Scheduled ping, also closing the connection on missing pongs."""
+        if not self._loop:
+            self._cancel_timers()
+            return
+        if monotonic() - self._last_received > PONG_TIMEOUT:
+            self._interrupt("No response in %s seconds" % PONG_TIMEOUT)
+            return
+        try:
             self._send_ping()
-            sleep(PH803W_PING_INTERVAL)
+        except OSError as e:
+            # The read loop detects and reports the broken connection
+            _LOGGER.debug("Ping failed: %s", e)
+
+    def _first_frame_timeout(self):
+        if self._loop and self._latest_measurement is None:
+            self._interrupt("No measurement in %s seconds" % FIRST_FRAME_TIMEOUT)
+
+    def _state_deadline(self):
+        self._interrupt(
+            "State %s passed its deadline" % self.state_machine.state.value
+        )
+
+    def _interrupt(self, reason):
+        """Make the blocking read loop fail with reason."""
+        self._interrupt_reason = reason
+        self._record_event(fr.EVENT_INTERRUPTED)
+        self._cancel_timers()
+        if not self._connected:
+            return
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _cancel_timers(self):
+        for timer in (self._ping_timer, self._first_frame_timer):
+            if timer is not None:
+                timer.cancel()
+        self._ping_timer = None
+        self._first_frame_timer = None
+
+    def _record_event(self, event):
+        if self.flight_recorder is not None:
+            self.flight_recorder.event(event)
 
     def abort(self):
+        """Stop the read loop, also when blocked waiting for data.
+
+        Final, also a run started after the abort fails."""
+        self._aborted = True
         self._loop = False
+        self._interrupt("Aborted")
 
     def close(self):
         self._loop = False
+        self._cancel_timers()
+        self.stop_profiling()
+        self.counters["closes"] += 1
+        self._record_event(fr.EVENT_CLOSED)
+        self.state_machine.transition(ConnectionState.STOPPED)
         self._latest_measurement = None
         # self._measurements.clear()
         try:
             self._socket.close()
         except:
             pass
+        for callback in self._close_callbacks:
+            callback()
         for callback in self._callbacks:
             callback()
 
+    def get_measurements(self):
+        """The latest measurements, oldest first."""
+        return list(self._measurements)
+
     def get_measurements_and_empty(self):
-        meas = self._measurements
+        meas = list(self._measurements)
         self._measurements.clear()
         return meas
 
@@ -236,48 +470,17 @@ class Device(object):
         self.close()
 
 
-class MeasOutlierFilter:
-    def __init__(self, ph: float, orp: float, history: int = 10) -> None:
-        self._ph_filter = OutlierFilter(ph, history)
-        self._orp_filter = OutlierFilter(orp, history)
-
-    def add(self, ph: float, orp: float) -> None:
-        self._ph_filter.add(ph)
-        self._orp_filter.add(orp)
-
-    def get_ph(self) -> float:
-        return self._ph_filter.get()
-
-    def get_orp(self) -> float:
-        return self._orp_filter.get()
-
-
-class OutlierFilter:
-    def __init__(self, init_value: float, history: int = 10) -> None:
-        self._values = []
-        self._values.append(init_value)
-        self._history = history
-
-    def add(self, value: float) -> None:
-        self._values.append(value)
-        if len(self._values) > self._history:
-            self._values.pop(0)
-
-    def get(self) -> float:
-        try:
-            stddev_val = stdev(self._values)
-            mean_val = mean(self._values)
-            for val in reversed(self._values):
-                if (val <= mean_val + stddev_val) and (val >= mean_val - stddev_val):
-                    return val
-        except StatisticsError:
-            return self._values[-1]
-        _LOGGER.warning("No match in outlier filter shall never happen!")
-        return self._values[-1]
-
-
 class Measurement:
-    def __init__(self, data) -> None:
+    def __init__(self, data, received: float = None) -> None:
+        # Monotonic time of the socket read, and of the callbacks having
+        # returned (only set when traced)
+        self.received = monotonic() if received is None else received
+        # Wall clock time, for history and aggregates
+        self.timestamp = time()
+        self.dispatched = None
+        self.traced = False
+        # Set once the first consumer recorded the latency of a traced one
+        self.written = False
         flag1 = data[8]
         self.in_water = flag1 & 0b0000_0100 != 0
         flag2 = data[9]
@@ -287,6 +490,9 @@ class Measurement:
         self.ph = int.from_bytes(ph_raw, "big") * 0.01
         orp_raw = data[12:14]
         self.orp = int.from_bytes(orp_raw, "big") - 2000
+        # Unfiltered values, kept when filtered values are added
+        self.raw_ph = self.ph
+        self.raw_orp = self.orp
         unknown1_raw = data[14:16]
         self.unknown1 = int.from_bytes(unknown1_raw, "big")
         unknown2_raw = data[15:18]
@@ -0,0 +1,155 @@
+"""A Prometheus metrics exporter for PH-803W devices.
+
+The text payload is rendered at most once per new frame (on the first
+scrape after it) and otherwise served as a prebuilt buffer."""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import threading
+
+METRICS_DEFAULT_PORT = 9803
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_LOGGER = logging.getLogger(__name__)
+
+# Name, type, help and Measurement attribute for the per-measurement metrics
+MEASUREMENT_METRICS = [
+    ("ph803w_ph", "gauge", "Filtered pH value", "ph"),
+    ("ph803w_ph_raw", "gauge", "Unfiltered pH value", "raw_ph"),
+    ("ph803w_orp_millivolts", "gauge", "Filtered ORP value", "orp"),
+    ("ph803w_orp_raw_millivolts", "gauge", "Unfiltered ORP value", "raw_orp"),
+    ("ph803w_in_water", "gauge", "Probe in water", "in_water"),
+    ("ph803w_ph_on", "gauge", "pH switch on", "ph_on"),
+    ("ph803w_orp_on", "gauge", "ORP switch on", "orp_on"),
+]
+# Name, help and Device.counters key for the connection counters
+COUNTER_METRICS = [
+    ("ph803w_connects_total", "Successful connections", "connects"),
+    ("ph803w_closes_total", "Closed connections", "closes"),
+    ("ph803w_frames_total", "Valid frames received", "frames"),
+    ("ph803w_measurements_total", "Measurements received", "measurements"),
+]
+
+
+class MetricsExporter(object):
+    def __init__(self, host: str = "", port: int = METRICS_DEFAULT_PORT):
+        self.host = host
+        self.port = port
+        self._devices = {}
+        self._generation = 0
+        self._payload = (-1, b"")
+        self._lock = threading.Lock()
+        self._server = None
+
+    def set_device(self, device):
+        """Export a device, replacing any earlier session with the same host."""
+        device.register_callback(self.invalidate)
+        with self._lock:
+            self._devices[device.host] = device
+        self.invalidate()
+
+    def invalidate(self):
+        self._generation += 1
+
+    def payload(self) -> bytes:
+        generation, payload = self._payload
+        if generation != self._generation:
+            with self._lock:
+                # Taken before rendering, so a frame arriving meanwhile
+                # invalidates the new payload again
+                generation = self._generation
+                payload = self._render()
+                self._payload = (generation, payload)
+        return payload
+
+    def _render(self) -> bytes:
+        devices = [
+            (device, '{host="%s",device="%s"}' % (host, device.get_unique_name()))
+            for host, device in self._devices.items()
+        ]
+        lines = [
+            "# HELP ph803w_up Device connected and measuring",
+            "# TYPE ph803w_up gauge",
+        ]
+        for device, labels in devices:
+            up = device.get_latest_measurement() is not None
+            lines.append("ph803w_up%s %d" % (labels, up))
+        for name, metric_type, description, attr in MEASUREMENT_METRICS:
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            for device, labels in devices:
+                measurement = device.get_latest_measurement()
+                if measurement is not None:
+                    lines.append(
+                        "%s%s %s" % (name, labels, float(getattr(measurement, attr)))
+                    )
+        lines.append("# HELP ph803w_connect_seconds Duration of the latest handshake")
+        lines.append("# TYPE ph803w_connect_seconds gauge")
+        for device, labels in devices:
+            if device.connect_time is not None:
+                lines.append("ph803w_connect_seconds%s %s" % (labels, device.connect_time))
+        for name, description, key in COUNTER_METRICS:
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s counter" % name)
+            for device, labels in devices:
+                lines.append("%s%s %d" % (name, labels, device.counters[key]))
+        traced = [(d, labels) for d, labels in devices if d.tracer is not None]
+        if traced:
+            name = "ph803w_latency_seconds"
+            lines.append("# HELP %s Measurement latency per stage" % name)
+            lines.append("# TYPE %s histogram" % name)
+            for device, labels in traced:
+                for stage, histogram in device.tracer.histograms.items():
+                    stage_labels = '%s,stage="%s"' % (labels[:-1], stage)
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(
+                            '%s_bucket%s,le="%s"} %d'
+                            % (name, stage_labels, bound, cumulative)
+                        )
+                    lines.append(
+                        '%s_bucket%s,le="+Inf"} %d'
+                        % (name, stage_labels, histogram.count)
+                    )
+                    lines.append("%s_sum%s} %s" % (name, stage_labels, histogram.sum))
+                    lines.append("%s_count%s} %d" % (name, stage_labels, histogram.count))
+        lines.append("")
+        return "\n".join(lines).encode("utf-8")
+
+    def start(self):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                payload = exporter.payload()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        thread.name = "Ph803wExporter"
+        thread.start()
+        _LOGGER.info("Metrics exporter listening on port %s", self.port)
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
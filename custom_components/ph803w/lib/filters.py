@@ -0,0 +1,196 @@
+"""Measurement filters for the PH-803W device values."""
+from bisect import bisect_left, insort
+from collections import deque
+from collections.abc import Mapping
+from math import sqrt
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class PassThroughFilter:
+    """No filtering, always returns the latest value."""
+
+    def __init__(self, init_value: float) -> None:
+        self._value = init_value
+
+    def add(self, value: float) -> None:
+        self._value = value
+
+    def get(self) -> float:
+        return self._value
+
+
+class OutlierFilter:
+    """Returns the latest value within one standard deviation of the history.
+
+    Sum and sum of squares are kept as running totals so adding a value is
+    O(1), only the (short) scan for an inlier depends on the history size."""
+
+    def __init__(self, init_value: float, history: int = 10) -> None:
+        self._values = deque([init_value], maxlen=history)
+        self._sum = init_value
+        self._sum_sq = init_value * init_value
+
+    def add(self, value: float) -> None:
+        if len(self._values) == self._values.maxlen:
+            oldest = self._values[0]
+            self._sum -= oldest
+            self._sum_sq -= oldest * oldest
+        self._values.append(value)
+        self._sum += value
+        self._sum_sq += value * value
+
+    def get(self) -> float:
+        count = len(self._values)
+        if count < 2:
+            return self._values[-1]
+        mean_val = self._sum / count
+        variance = (self._sum_sq - count * mean_val * mean_val) / (count - 1)
+        # Allow for rounding errors in the running totals
+        stddev_val = sqrt(max(variance, 0.0)) + 1e-9 * max(1.0, abs(mean_val))
+        for val in reversed(self._values):
+            if (val <= mean_val + stddev_val) and (val >= mean_val - stddev_val):
+                return val
+        _LOGGER.warning("No match in outlier filter shall never happen!")
+        return self._values[-1]
+
+
+class EmaFilter:
+    """Exponential moving average, alpha is the weight of the newest value."""
+
+    def __init__(self, init_value: float, alpha: float = 0.3) -> None:
+        if not 0 < alpha <= 1:
+            raise ValueError("alpha must be in range (0, 1]")
+        self._alpha = alpha
+        self._value = init_value
+
+    def add(self, value: float) -> None:
+        self._value += self._alpha * (value - self._value)
+
+    def get(self) -> float:
+        return self._value
+
+
+class MedianFilter:
+    """Rolling median over the last values.
+
+    The window is kept both in arrival order (to know what to evict) and
+    sorted (bisect), giving a logarithmic search per update."""
+
+    def __init__(self, init_value: float, history: int = 5) -> None:
+        self._history = history
+        self._window = deque([init_value])
+        self._sorted = [init_value]
+
+    def add(self, value: float) -> None:
+        if len(self._window) == self._history:
+            oldest = self._window.popleft()
+            del self._sorted[bisect_left(self._sorted, oldest)]
+        self._window.append(value)
+        insort(self._sorted, value)
+
+    def get(self) -> float:
+        count = len(self._sorted)
+        middle = count // 2
+        if count % 2:
+            return self._sorted[middle]
+        return (self._sorted[middle - 1] + self._sorted[middle]) / 2
+
+
+class KalmanFilter:
+    """Scalar Kalman filter for a (nearly) constant value.
+
+    The noise parameters are in the unit of the channel squared, so they
+    need to be tuned per probe (pH and ORP are on very different scales)."""
+
+    def __init__(
+        self,
+        init_value: float,
+        process_noise: float = 1e-4,
+        measurement_noise: float = 1e-2,
+        init_error: float = 1.0,
+    ) -> None:
+        self._value = init_value
+        self._error = init_error
+        self._process_noise = process_noise
+        self._measurement_noise = measurement_noise
+
+    def add(self, value: float) -> None:
+        error = self._error + self._process_noise
+        gain = error / (error + self._measurement_noise)
+        self._value += gain * (value - self._value)
+        self._error = (1 - gain) * error
+
+    def get(self) -> float:
+        return self._value
+
+
+FILTERS = {
+    "none": PassThroughFilter,
+    "outlier": OutlierFilter,
+    "ema": EmaFilter,
+    "median": MedianFilter,
+    "kalman": KalmanFilter,
+}
+DEFAULT_FILTER = "outlier"
+# Keyword parameters accepted by each filter, besides the initial value
+FILTER_PARAMETERS = {
+    "none": (),
+    "outlier": ("history",),
+    "ema": ("alpha",),
+    "median": ("history",),
+    "kalman": ("process_noise", "measurement_noise", "init_error"),
+}
+
+
+def create_filter(spec, init_value: float):
+    """Create a filter from a name in FILTERS, a mapping of its "type" and
+    parameters (e.g. {"type": "ema", "alpha": 0.1}) or a factory taking the
+    initial value."""
+    if spec is None:
+        spec = DEFAULT_FILTER
+    if callable(spec):
+        return spec(init_value)
+    parameters = {}
+    if isinstance(spec, Mapping):
+        parameters = dict(spec)
+        spec = parameters.pop("type", DEFAULT_FILTER)
+    if spec not in FILTERS:
+        raise ValueError("Unknown filter: %s" % spec)
+    unknown = set(parameters) - set(FILTER_PARAMETERS[spec])
+    if unknown:
+        raise ValueError(
+            "Unknown parameters for filter %s: %s" % (spec, ", ".join(sorted(unknown)))
+        )
+    return FILTERS[spec](init_value, **parameters)
+
+
+class MeasFilter:
+    """Filter chain for one device, with a separate filter per channel."""
+
+    def __init__(
+        self, ph: float, orp: float, ph_filter=DEFAULT_FILTER, orp_filter=DEFAULT_FILTER
+    ) -> None:
+        self._ph_filter = create_filter(ph_filter, ph)
+        self._orp_filter = create_filter(orp_filter, orp)
+
+    def add(self, ph: float, orp: float) -> None:
+        self._ph_filter.add(ph)
+        self._orp_filter.add(orp)
+
+    def get_ph(self) -> float:
+        return self._ph_filter.get()
+
+    def get_orp(self) -> float:
+        return self._orp_filter.get()
+
+
+class MeasOutlierFilter(MeasFilter):
+    def __init__(self, ph: float, orp: float, history: int = 10) -> None:
+        super().__init__(
+            ph,
+            orp,
+            lambda value: OutlierFilter(value, history),
+            lambda value: OutlierFilter(value, history),
+        )
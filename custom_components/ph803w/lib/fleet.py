@@ -0,0 +1,66 @@
+"""Orchestration of connections to a fleet of PH-803W devices."""
+from contextlib import contextmanager
+import heapq
+import itertools
+import threading
+from time import monotonic
+
+MAX_CONCURRENT_CONNECTS = 4
+CONNECT_STAGGER = 0.25
+
+
+class ConnectionGate(object):
+    """Admits device handshakes under a concurrency limit.
+
+    Waiting devices are admitted in priority order (hosts listed in
+    priority first, in that order, then the others in arrival order) with
+    at least stagger seconds between two starts, so a restart does not
+    flood the access point with simultaneous connects."""
+
+    def __init__(
+        self,
+        max_concurrent: int = MAX_CONCURRENT_CONNECTS,
+        stagger: float = CONNECT_STAGGER,
+        priority=(),
+    ):
+        self.max_concurrent = max_concurrent
+        self.stagger = stagger
+        self.set_priority(priority)
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._active = 0
+        self._next_start = 0
+        self._condition = threading.Condition()
+
+    def set_priority(self, priority):
+        self._priority = {host: rank for rank, host in enumerate(priority)}
+
+    def acquire(self, host):
+        entry = (self._priority.get(host, len(self._priority)), next(self._sequence))
+        with self._condition:
+            heapq.heappush(self._waiting, entry)
+            while True:
+                if self._waiting[0] == entry and self._active < self.max_concurrent:
+                    delay = self._next_start - monotonic()
+                    if delay <= 0:
+                        break
+                    self._condition.wait(delay)
+                else:
+                    self._condition.wait()
+            heapq.heappop(self._waiting)
+            self._active += 1
+            self._next_start = monotonic() + self.stagger
+            self._condition.notify_all()
+
+    def release(self):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, host):
+        self.acquire(host)
+        try:
+            yield
+        finally:
+            self.release()
@@ -0,0 +1,97 @@
+"""A flight recorder of the latest raw frames and connection events.
+
+Recording only copies into preallocated buffers, all formatting is done
+when the content is dumped."""
+from array import array
+from time import monotonic, time
+
+FRAME_SIZE = 32
+RECORDED_FRAMES = 64
+RECORDED_EVENTS = 32
+
+EVENT_CONNECTING = 1
+EVENT_CONNECTED = 2
+EVENT_CLOSED = 3
+EVENT_CLOSED_BY_DEVICE = 4
+EVENT_TIMEOUT = 5
+EVENT_INTERRUPTED = 6
+EVENT_ERROR = 7
+
+EVENT_NAMES = {
+    EVENT_CONNECTING: "connecting",
+    EVENT_CONNECTED: "connected",
+    EVENT_CLOSED: "closed",
+    EVENT_CLOSED_BY_DEVICE: "closed_by_device",
+    EVENT_TIMEOUT: "timeout",
+    EVENT_INTERRUPTED: "interrupted",
+    EVENT_ERROR: "error",
+}
+
+
+class FlightRecorder:
+    def __init__(
+        self,
+        frames: int = RECORDED_FRAMES,
+        events: int = RECORDED_EVENTS,
+        frame_size: int = FRAME_SIZE,
+    ) -> None:
+        self._frame_size = frame_size
+        self._frames = bytearray(frames * frame_size)
+        self._frame_lengths = array("H", bytes(2 * frames))
+        self._frame_times = array("d", bytes(8 * frames))
+        self._frame_count = 0
+        self._events = array("B", bytes(events))
+        self._event_times = array("d", bytes(8 * events))
+        self._event_count = 0
+
+    def frame(self, data, received: float) -> None:
+        """Record a raw frame (truncated to frame_size) received at monotonic time."""
+        slot = self._frame_count % len(self._frame_lengths)
+        length = min(len(data), self._frame_size)
+        offset = slot * self._frame_size
+        self._frames[offset : offset + length] = memoryview(data)[:length]
+        self._frame_lengths[slot] = len(data)
+        self._frame_times[slot] = received
+        self._frame_count += 1
+
+    def event(self, event: int) -> None:
+        slot = self._event_count % len(self._events)
+        self._events[slot] = event
+        self._event_times[slot] = monotonic()
+        self._event_count += 1
+
+    def dump(self) -> dict:
+        """Recorded frames and events, oldest first, with wall clock times."""
+        offset = time() - monotonic()
+        frames = []
+        for slot in self._slots(self._frame_count, len(self._frame_lengths)):
+            length = self._frame_lengths[slot]
+            start = slot * self._frame_size
+            stored = min(length, self._frame_size)
+            frames.append(
+                {
+                    "time": self._frame_times[slot] + offset,
+                    "length": length,
+                    "data": self._frames[start : start + stored].hex(),
+                }
+            )
+        events = [
+            {
+                "time": self._event_times[slot] + offset,
+                "event": EVENT_NAMES.get(self._events[slot], self._events[slot]),
+            }
+            for slot in self._slots(self._event_count, len(self._events))
+        ]
+        return {
+            "frames_recorded": self._frame_count,
+            "events_recorded": self._event_count,
+            "frames": frames,
+            "events": events,
+        }
+
+    @staticmethod
+    def _slots(count, size):
+        if count <= size:
+            return range(count)
+        first = count % size
+        return [(first + i) % size for i in range(size)]
@@ -0,0 +1,96 @@
+"""Latency tracing of PH-803W measurements.
+
+Every traced Measurement carries monotonic timestamps from the socket read
+onwards, the time spent in each stage is collected in fixed histograms."""
+from bisect import bisect_left
+
+# Upper bounds in seconds, the last bucket is unbounded
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+)
+
+# decode: socket read until decoded, filter: filter update,
+# callbacks: device callbacks (thread), handoff: callbacks returned until the
+# first consumer (event loop) picks it up, write_state: state write of that
+# consumer, total: socket read until written
+STAGES = ("decode", "filter", "callbacks", "handoff", "write_state", "total")
+
+
+class LatencyHistogram:
+    def __init__(self, buckets=LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q: float) -> float:
+        """Upper bucket bound of the quantile, at most the max observed."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def mean(self) -> float:
+        if self.count == 0:
+            return 0.0
+        return self.sum / self.count
+
+
+class LatencyTracer:
+    """Histograms per stage, tracing a sample_rate share of the measurements."""
+
+    def __init__(self, sample_rate: float = 1.0) -> None:
+        if not 0 < sample_rate <= 1:
+            raise ValueError("sample_rate must be in range (0, 1]")
+        self.sample_rate = sample_rate
+        self.histograms = {stage: LatencyHistogram() for stage in STAGES}
+        self._credit = 0.0
+
+    def sample(self) -> bool:
+        self._credit += self.sample_rate
+        if self._credit >= 1:
+            self._credit -= 1
+            return True
+        return False
+
+    def observe(self, stage: str, seconds: float) -> None:
+        self.histograms[stage].observe(seconds)
+
+    def summary(self) -> dict:
+        """Count, mean, p50, p95 and max (in ms) per stage."""
+        return {
+            stage: {
+                "count": histogram.count,
+                "mean_ms": round(histogram.mean() * 1000, 3),
+                "p50_ms": round(histogram.quantile(0.5) * 1000, 3),
+                "p95_ms": round(histogram.quantile(0.95) * 1000, 3),
+                "max_ms": round(histogram.max * 1000, 3),
+            }
+            for stage, histogram in self.histograms.items()
+        }
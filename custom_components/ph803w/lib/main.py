@@ -1,8 +1,13 @@
 if __name__ == '__main__':
 
     import asyncio
-    import discovery, device
     import logging
+    import os
+    import sys
+
+    # Import as package "lib" so the modules can use relative imports
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from lib import discovery, device
 
     logging.basicConfig(level=logging.DEBUG)
     _LOGGER = logging.getLogger(__name__)
@@ -0,0 +1,70 @@
+"""Time limited profiling of the PH-803W frame handling."""
+import cProfile
+import logging
+from time import monotonic, perf_counter
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Profiler:
+    """Collects call count, total and max time per named step.
+
+    With use_cprofile a full cProfile of the device thread is written to
+    path (pstats format) instead of the step timings (text)."""
+
+    def __init__(self, duration: float, path: str, use_cprofile: bool = False) -> None:
+        self.path = path
+        self.timings = {}
+        self._end = monotonic() + duration
+        self._cprofile = cProfile.Profile() if use_cprofile else None
+        self._enabled = False
+
+    def enable(self) -> None:
+        """Start profiling, must be called from the profiled thread."""
+        if self._cprofile is not None and not self._enabled:
+            self._cprofile.enable()
+        self._enabled = True
+
+    def lap(self, name: str, start: float) -> float:
+        """Record the time since start (perf_counter) for name, returns now."""
+        now = perf_counter()
+        elapsed = now - start
+        timing = self.timings.get(name)
+        if timing is None:
+            self.timings[name] = [1, elapsed, elapsed]
+        else:
+            timing[0] += 1
+            timing[1] += elapsed
+            if elapsed > timing[2]:
+                timing[2] = elapsed
+        return now
+
+    def expired(self) -> bool:
+        return monotonic() > self._end
+
+    def finish(self) -> None:
+        """Stop profiling and write the results, a write error is only logged."""
+        if self._cprofile is not None and self._enabled:
+            self._cprofile.disable()
+        try:
+            if self._cprofile is not None:
+                self._cprofile.dump_stats(self.path)
+            else:
+                with open(self.path, "w") as file:
+                    file.write(self.report())
+        except OSError as e:
+            _LOGGER.error("Profiling results not written to %s: %s", self.path, e)
+            return
+        _LOGGER.info("Profiling results written to %s", self.path)
+
+    def report(self) -> str:
+        lines = [
+            "%-20s %8s %12s %12s %12s"
+            % ("step", "calls", "total ms", "mean ms", "max ms")
+        ]
+        for name, (count, total, maximum) in sorted(self.timings.items()):
+            lines.append(
+                "%-20s %8d %12.3f %12.4f %12.4f"
+                % (name, count, total * 1000, total * 1000 / count, maximum * 1000)
+            )
+        return "\n".join(lines) + "\n"
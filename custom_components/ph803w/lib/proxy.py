@@ -0,0 +1,252 @@
+"""A local fan-out proxy for a PH-803W device.
+
+The device only accepts a single TCP client. The proxy holds that one
+upstream session (a connected Device) and serves the same protocol to any
+number of local clients, answering the handshake and pings itself and
+forwarding the data frames received from the device. A plain Device
+pointed to the proxy host and port works as a client."""
+from collections import deque
+import logging
+import socket
+import threading
+
+from .device import PH803W_DEFAULT_TCP_PORT, SOCKET_TIMEOUT
+
+CLIENT_BUFFER_SIZE = 50
+FRAME_PREFIX = bytes.fromhex("00000003")
+# The clients get the passcode and data unauthenticated, local host only
+# unless another address is configured
+DEFAULT_PROXY_HOST = "127.0.0.1"
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class DeviceProxyError(ConnectionError):
+    pass
+
+
+def _frame(message_type: int, body: bytes = b"") -> bytes:
+    return (
+        FRAME_PREFIX
+        + (len(body) + 3).to_bytes(1, "big")
+        + bytes.fromhex("0000")
+        + message_type.to_bytes(1, "big")
+        + body
+    )
+
+
+def _split_frames(data):
+    """Split data into whole frames, returns them and the incomplete rest.
+
+    Frames too short to hold a message type are dropped, after garbled
+    data the split resumes at the next frame prefix."""
+    frames = []
+    while len(data) >= 5:
+        if not data.startswith(FRAME_PREFIX):
+            start = data.find(FRAME_PREFIX, 1)
+            # Keep what may be the start of a prefix
+            data = data[start:] if start != -1 else data[1 - len(FRAME_PREFIX) :]
+            continue
+        length = data[4] + 5
+        if len(data) < length:
+            break
+        if length >= 8:
+            frames.append(data[:length])
+        data = data[length:]
+    return frames, data
+
+
+class DeviceProxy(object):
+    def __init__(
+        self,
+        host: str = DEFAULT_PROXY_HOST,
+        port: int = PH803W_DEFAULT_TCP_PORT,
+        buffer_size: int = CLIENT_BUFFER_SIZE,
+    ):
+        self.host = host
+        self.port = port
+        self.device = None
+        self._buffer_size = buffer_size
+        self._latest_frame = None
+        self._clients = set()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def attach(self, device):
+        """Use a (new) upstream device session, frames from the old one are dropped."""
+        self.device = device
+        device.register_frame_callback(lambda data: self._handle_frame(device, data))
+        device.register_close_callback(lambda: self._device_closed(device))
+
+    def start(self):
+        self._server = socket.create_server((self.host, self.port))
+        self._thread = threading.Thread(target=self._accept_loop, daemon=True)
+        self._thread.name = "Ph803wProxy"
+        self._thread.start()
+        _LOGGER.info("Proxy listening on %s port %s", self.host, self.port)
+
+    def close(self):
+        server = self._server
+        self._server = None
+        if server is not None:
+            try:
+                server.close()
+            except OSError:
+                pass
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            client.close()
+
+    def passcode(self):
+        if self.device is None:
+            return None
+        return self.device.passcode or None
+
+    def _accept_loop(self):
+        while self._server is not None:
+            try:
+                conn, address = self._server.accept()
+            except OSError:
+                break
+            _LOGGER.debug("Proxy client connected from %s", address[0])
+            # Clients ping regularly, a silent one is gone
+            conn.settimeout(SOCKET_TIMEOUT)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = ProxyClient(self, conn, self._buffer_size)
+            with self._lock:
+                self._clients.add(client)
+            client.start()
+
+    def _handle_frame(self, device, data):
+        if device is not self.device or data[7] != 0x91:
+            return
+        frame = bytes(data)
+        self._latest_frame = frame
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            client.push(frame)
+
+    def _device_closed(self, device):
+        """Close the clients with the upstream session, so they reconnect.
+
+        The proxy answers their pings itself, without this they would wait
+        for data forever."""
+        if device is not self.device:
+            return
+        self._latest_frame = None
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            client.close()
+
+    def _remove(self, client):
+        with self._lock:
+            self._clients.discard(client)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class ProxyClient(object):
+    """One local client, with its own bounded buffer of frames to send.
+
+    A slow client drops its oldest frames instead of delaying the others."""
+
+    def __init__(self, proxy, conn, buffer_size):
+        self._proxy = proxy
+        self._conn = conn
+        self._buffer = deque(maxlen=buffer_size)
+        self._ready = threading.Condition()
+        self._streaming = False
+        self._open = True
+        self._send_lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._read_loop, daemon=True).start()
+        threading.Thread(target=self._write_loop, daemon=True).start()
+
+    def push(self, frame):
+        if not self._streaming:
+            return
+        with self._ready:
+            self._buffer.append(frame)
+            self._ready.notify()
+
+    def close(self):
+        with self._ready:
+            self._open = False
+            self._ready.notify()
+        try:
+            # Also ends a recv blocked in the read thread
+            self._conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self._conn.close()
+        except OSError:
+            pass
+        self._proxy._remove(self)
+
+    def _send(self, data):
+        with self._send_lock:
+            self._conn.sendall(data)
+
+    def _read_loop(self):
+        # Bytes of a frame split over reads
+        pending = b""
+        try:
+            while self._open:
+                data = self._conn.recv(1024)
+                if len(data) == 0:
+                    break
+                frames, pending = _split_frames(pending + data)
+                for frame in frames:
+                    self._handle_request(frame)
+        except (OSError, DeviceProxyError) as e:
+            _LOGGER.debug("Proxy client error: %s", e)
+        finally:
+            self.close()
+
+    def _handle_request(self, data):
+        message_type = data[7]
+        if message_type == 0x06:
+            passcode = self._proxy.passcode()
+            if passcode is None:
+                raise DeviceProxyError("No upstream device connected")
+            passcode_raw = passcode.encode("utf-8")
+            self._send(
+                _frame(0x07, b"\x00" + len(passcode_raw).to_bytes(1, "big") + passcode_raw)
+            )
+        elif message_type == 0x08:
+            self._send(_frame(0x09, b"\x00"))
+        elif message_type == 0x15:
+            self._send(_frame(0x16))
+        elif message_type == 0x90:
+            self._streaming = True
+            latest = self._proxy._latest_frame
+            if latest is not None:
+                self.push(latest)
+        else:
+            _LOGGER.debug("Proxy ignoring message type %s", message_type)
+
+    def _write_loop(self):
+        try:
+            while True:
+                with self._ready:
+                    while self._open and not self._buffer:
+                        self._ready.wait()
+                    if not self._open:
+                        return
+                    frames = b"".join(self._buffer)
+                    self._buffer.clear()
+                self._send(frames)
+        except OSError as e:
+            _LOGGER.debug("Proxy client error: %s", e)
+            self.close()
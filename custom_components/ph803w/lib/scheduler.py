@@ -0,0 +1,103 @@
+"""A shared timer for keepalives, deadlines and backoffs of many devices.
+
+One thread runs every timer from a heap, instead of a sleeping thread per
+device. Repeating timers are staggered over their interval so devices
+started together do not wake up together."""
+import heapq
+import itertools
+import logging
+import threading
+from time import monotonic
+
+# Fraction of the interval between consecutive staggered timers, the golden
+# ratio spreads any number of timers evenly
+STAGGER_STEP = 0.618033988749895
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Timer(object):
+    __slots__ = ("when", "interval", "function", "cancelled")
+
+    def __init__(self, when, interval, function):
+        self.when = when
+        self.interval = interval
+        self.function = function
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler(object):
+    def __init__(self):
+        self._heap = []
+        self._sequence = itertools.count()
+        self._staggered = 0
+        self._wakeup = threading.Condition()
+        self._thread = None
+
+    def call_later(self, delay: float, function) -> Timer:
+        """Call function (in the scheduler thread) after delay seconds."""
+        return self._add(Timer(monotonic() + delay, None, function))
+
+    def call_every(self, interval: float, function, stagger: bool = True) -> Timer:
+        """Call function every interval seconds until cancelled."""
+        delay = interval
+        if stagger:
+            delay = interval * ((self._staggered * STAGGER_STEP) % 1)
+            self._staggered += 1
+        return self._add(Timer(monotonic() + delay, interval, function))
+
+    def _add(self, timer):
+        with self._wakeup:
+            heapq.heappush(self._heap, (timer.when, next(self._sequence), timer))
+            self._start()
+            self._wakeup.notify()
+        return timer
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.name = "Ph803wScheduler"
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            with self._wakeup:
+                while True:
+                    while self._heap and self._heap[0][2].cancelled:
+                        heapq.heappop(self._heap)
+                    timeout = None
+                    if self._heap:
+                        timeout = self._heap[0][0] - monotonic()
+                        if timeout <= 0:
+                            break
+                    self._wakeup.wait(timeout)
+                timer = heapq.heappop(self._heap)[2]
+                if timer.interval is not None:
+                    # Based on the planned time so the stagger is kept,
+                    # skipping any periods missed
+                    now = monotonic()
+                    while timer.when <= now:
+                        timer.when += timer.interval
+                    heapq.heappush(
+                        self._heap, (timer.when, next(self._sequence), timer)
+                    )
+            try:
+                timer.function()
+            except Exception:
+                _LOGGER.exception("Error in scheduled function")
+
+
+_default_scheduler = None
+_default_lock = threading.Lock()
+
+
+def get_scheduler() -> Scheduler:
+    """The scheduler shared by all devices."""
+    global _default_scheduler
+    with _default_lock:
+        if _default_scheduler is None:
+            _default_scheduler = Scheduler()
+        return _default_scheduler
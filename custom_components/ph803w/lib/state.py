@@ -0,0 +1,72 @@
+"""Connection state machine of a PH-803W device."""
+from enum import Enum
+import logging
+import threading
+from time import monotonic
+
+from .scheduler import get_scheduler
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class ConnectionState(Enum):
+    STOPPED = "stopped"
+    DISCOVERING = "discovering"
+    CONNECTING = "connecting"
+    HANDSHAKE = "handshake"
+    STREAMING = "streaming"
+    BACKOFF = "backoff"
+
+
+# Seconds a state may last before its deadline action is called, states not
+# listed have no deadline (discovering waits for the resolver and the
+# connection gate, connecting is bounded by the socket timeout and streaming
+# is supervised by the ping timeouts)
+STATE_DEADLINES = {
+    ConnectionState.HANDSHAKE: 10,
+}
+
+
+class ConnectionStateMachine(object):
+    def __init__(self, scheduler=None, deadlines=STATE_DEADLINES):
+        self.state = ConnectionState.STOPPED
+        self.since = monotonic()
+        self._deadlines = deadlines
+        self._scheduler = scheduler or get_scheduler()
+        self._deadline_timer = None
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, listener):
+        """Register a function called with (old_state, new_state) on transitions."""
+        self._listeners.append(listener)
+
+    def transition(self, state: ConnectionState, on_deadline=None, deadline=None):
+        """Enter state, calling on_deadline if it is still active after its deadline.
+
+        The deadline defaults to the one configured for the state."""
+        with self._lock:
+            if self._deadline_timer is not None:
+                self._deadline_timer.cancel()
+                self._deadline_timer = None
+            old_state = self.state
+            self.state = state
+            self.since = monotonic()
+            if deadline is None:
+                deadline = self._deadlines.get(state)
+            if deadline is not None and on_deadline is not None:
+                since = self.since
+                self._deadline_timer = self._scheduler.call_later(
+                    deadline, lambda: self._expired(state, since, on_deadline)
+                )
+        if old_state is not state:
+            _LOGGER.debug("State %s -> %s", old_state.value, state.value)
+            for listener in self._listeners:
+                listener(old_state, state)
+
+    def _expired(self, state, since, on_deadline):
+        with self._lock:
+            if self.state is not state or self.since != since:
+                return
+        _LOGGER.debug("Deadline of state %s passed", state.value)
+        on_deadline()
@@ -0,0 +1,69 @@
+"""Import of PH-803W aggregates into the long-term statistics."""
+from __future__ import annotations
+
+from collections import defaultdict
+import logging
+import threading
+
+from homeassistant.components.recorder.models import StatisticData, StatisticMetaData
+from homeassistant.components.recorder.statistics import async_add_external_statistics
+from homeassistant.const import UnitOfElectricPotential
+from homeassistant.core import HomeAssistant
+from homeassistant.util import dt as dt_util, slugify
+
+from .const import DOMAIN
+
+_LOGGER = logging.getLogger(__name__)
+
+# Long-term statistics are hourly, shorter aggregates are kept in the device data
+STATISTICS_PERIOD = 3600
+
+CHANNELS = {
+    "ph": ("pH", None),
+    "orp": ("ORP", UnitOfElectricPotential.MILLIVOLT),
+}
+
+
+class StatisticsImporter:
+    """Collects hourly aggregates and imports them in batches."""
+
+    def __init__(self, hass: HomeAssistant) -> None:
+        self.hass = hass
+        self._pending = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def add(self, host, channel, aggregate) -> None:
+        """Queue an ended aggregate, may be called from any thread."""
+        if aggregate.period != STATISTICS_PERIOD or channel not in CHANNELS:
+            return
+        with self._lock:
+            self._pending[(host, channel)].append(aggregate)
+
+    async def async_flush(self, now=None) -> None:
+        """Import all queued aggregates, one batch per statistic."""
+        with self._lock:
+            pending = self._pending
+            self._pending = defaultdict(list)
+        for (host, channel), aggregates in pending.items():
+            name, unit = CHANNELS[channel]
+            metadata = StatisticMetaData(
+                has_mean=True,
+                has_sum=False,
+                name=f"PH-803W {host} {name}",
+                source=DOMAIN,
+                statistic_id=f"{DOMAIN}:{slugify(host)}_{channel}",
+                unit_of_measurement=unit,
+            )
+            statistics = [
+                StatisticData(
+                    start=dt_util.utc_from_timestamp(aggregate.start),
+                    mean=aggregate.mean,
+                    min=aggregate.min,
+                    max=aggregate.max,
+                )
+                for aggregate in aggregates
+            ]
+            _LOGGER.debug(
+                "Importing %s statistics for %s", len(statistics), metadata["statistic_id"]
+            )
+            async_add_external_statistics(self.hass, metadata, statistics)
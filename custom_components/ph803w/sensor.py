@@ -1,55 +1,66 @@
 """Platform for sensor integration."""
 from __future__ import annotations
-import logging
+from dataclasses import dataclass
+import time
 
 from homeassistant.components.sensor import (
     ENTITY_ID_FORMAT,
     SensorDeviceClass,
     SensorEntity,
+    SensorEntityDescription,
 )
 from homeassistant.const import UnitOfElectricPotential
 from homeassistant.core import HomeAssistant, callback
-from homeassistant.helpers.dispatcher import async_dispatcher_connect
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
 from homeassistant.helpers.typing import ConfigType, DiscoveryInfoType
 from homeassistant.util import slugify
-from homeassistant.exceptions import PlatformNotReady
 
-from . import UPDATE_TOPIC
 from .const import DOMAIN
+from .entity import DeviceEntity, DeviceEntityDescription, async_setup_device_entities
+from .lib.state import ConnectionState
 
-_LOGGER = logging.getLogger(__name__)
-
-
-class DeviceSensorConfig:
-    """PH-803W Device Sensor configuration."""
-
-    def __init__(
-        self,
-        friendly_name,
-        field,
-        icon="mdi:gauge",
-        unit_of_measurement=None,
-        device_class=None,
-    ):
-        """Initialize configuration."""
-        self.device_class = device_class
-        self.friendly_name = friendly_name
-        self.field = field
-        self.icon = icon
-        self.unit_of_measurement = unit_of_measurement
-
-
-SENSORS = [
-    DeviceSensorConfig("PH-803W pH", "ph", "mdi:water-percent", ""),
-    DeviceSensorConfig(
-        "PH-803W ORP",
-        "orp",
-        "mdi:water-opacity",
-       UnitOfElectricPotential.MILLIVOLT,
-        SensorDeviceClass.VOLTAGE,
+
+@dataclass(frozen=True, kw_only=True)
+class DeviceSensorEntityDescription(DeviceEntityDescription, SensorEntityDescription):
+    """Describes a PH-803W sensor."""
+
+
+SENSORS = (
+    DeviceSensorEntityDescription(
+        key="ph",
+        name="PH-803W pH",
+        icon="mdi:water-percent",
+        native_unit_of_measurement="",
+    ),
+    DeviceSensorEntityDescription(
+        key="orp",
+        name="PH-803W ORP",
+        icon="mdi:water-opacity",
+        native_unit_of_measurement=UnitOfElectricPotential.MILLIVOLT,
+        device_class=SensorDeviceClass.VOLTAGE,
+    ),
+    DeviceSensorEntityDescription(
+        key="raw_ph",
+        name="PH-803W pH raw",
+        icon="mdi:water-percent",
+        native_unit_of_measurement="",
+    ),
+    DeviceSensorEntityDescription(
+        key="raw_orp",
+        name="PH-803W ORP raw",
+        icon="mdi:water-opacity",
+        native_unit_of_measurement=UnitOfElectricPotential.MILLIVOLT,
+        device_class=SensorDeviceClass.VOLTAGE,
     ),
-]
+)
+
+CONNECTION_STATE_SENSOR = DeviceSensorEntityDescription(
+    key="connection_state",
+    name="PH-803W Connection state",
+    icon="mdi:lan-connect",
+    device_class=SensorDeviceClass.ENUM,
+    options=[state.value for state in ConnectionState],
+)
 
 
 async def async_setup_platform(
@@ -62,100 +73,58 @@ async def async_setup_platform(
     if discovery_info is None:
         return
 
-    sensors = []
-    device_data = hass.data[DOMAIN]
-    if not device_data.connected():
-        raise PlatformNotReady(f"PH-803W not connected yet")
-
-    _LOGGER.info(f"PH-803W connected, creating entities")
-    for sconfig in SENSORS:
-        sensors.append(DeviceSensor(device_data, sconfig))
+    # The connection state is also of interest before a device ever connected
+    async_add_entities(
+        [
+            ConnectionStateSensor(device_data, CONNECTION_STATE_SENSOR)
+            for device_data in hass.data[DOMAIN].values()
+        ]
+    )
+    async_setup_device_entities(
+        hass,
+        async_add_entities,
+        lambda device_data: [
+            DeviceSensor(device_data, description) for description in SENSORS
+        ],
+    )
+
+
+class DeviceSensor(DeviceEntity, SensorEntity):
+    """Implementing the PH-803W sensor."""
+
+    entity_description: DeviceSensorEntityDescription
+    entity_id_format = ENTITY_ID_FORMAT
+    _value_attr = "_attr_native_value"
+    _last_write = 0
+
+    def _skip_update(self, measurement) -> bool:
+        interval = self.device_data.state_interval
+        if interval and measurement is not None and self._attr_native_value is not None:
+            # Limit the state writes (and recorder rows) of the values
+            now = time.monotonic()
+            if now - self._last_write < interval:
+                return True
+            self._last_write = now
+        return False
 
-    async_add_entities(sensors)
 
+class ConnectionStateSensor(DeviceSensor):
+    """Connection state of the device.
 
-class DeviceSensor(SensorEntity):
-    """Implementing the Waterfurnace sensor."""
+    Created before the device is connected, so identified by the host
+    without the passcode and not linked to the device."""
 
-    def __init__(self, device_data, config):
+    def __init__(self, device_data, description: DeviceSensorEntityDescription):
         """Initialize the sensor."""
-        self.device_data = device_data
-        self._name = config.friendly_name
-        self._attr = config.field
-        self._state = None
-
-        measurement = self.device_data.measurement()
-        if measurement is not None:
-            self._state = getattr(
-                measurement,
-                self._attr,
-                None,
-            )
-
-        self._icon = config.icon
-        self._unit_of_measurement = config.unit_of_measurement
-        self._attr_device_class = config.device_class
-
-        # This ensures that the sensors are isolated per waterfurnace unit
-        self.entity_id = ENTITY_ID_FORMAT.format(
-            f"wf_{slugify(self.device_data.host)}_{slugify(self._attr)}"
-        )
-
-    @property
-    def name(self):
-        """Return the name of the sensor."""
-        return self._name
-
-    @property
-    def device_info(self):
-        """Return information to link this entity with the correct device."""
-        return {
-            "identifiers": {(DOMAIN, self.device_data.passcode())},
-            "name": self.device_data.unique_name(),
-        }
-
-    @property
-    def unique_id(self):
-        """Return the sensor unique id."""
-        return self.device_data.passcode() + self._attr
-
-    @property
-    def native_value(self):
-        """Return the state of the sensor."""
-        return self._state
-
-    @property
-    def icon(self):
-        """Return icon."""
-        return self._icon
-
-    @property
-    def native_unit_of_measurement(self):
-        """Return the units of measurement."""
-        return self._unit_of_measurement
-
-    @property
-    def should_poll(self):
-        """Return the polling state."""
-        return False
+        super().__init__(device_data, description)
+        self._attr_unique_id = f"{slugify(device_data.host)}_{description.key}"
+        self._attr_device_info = None
 
-    async def async_added_to_hass(self):
-        """Register callbacks."""
-        self.async_on_remove(
-            async_dispatcher_connect(
-                self.hass, UPDATE_TOPIC, self.async_update_callback
-            )
-        )
+    def _update_value(self, measurement) -> None:
+        self._attr_native_value = self.device_data.state_machine.state.value
 
     @callback
-    def async_update_callback(self):
-        """Update state."""
-        if self.device_data.measurement() is not None:
-            self._state = getattr(
-                self.device_data.measurement(),
-                self._attr,
-                None,
-            )
-        else:
-            self._state = None
+    def async_update_callback(self) -> None:
+        """Update state, not part of the measurement latency."""
+        self._update_value(None)
         self.async_write_ha_state()